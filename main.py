@@ -1,13 +1,37 @@
 from __future__ import annotations
 
-import json
+import asyncio
 import math
 import os
+import queue
+import random
+import secrets
+import shutil
 import sqlite3
+import threading
+import time
 import uuid
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Set
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
+import orjson
+from cachetools import TTLCache
 from fastapi import (
     FastAPI,
     File,
@@ -18,6 +42,7 @@ from fastapi import (
     WebSocket,
     WebSocketDisconnect,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
@@ -27,143 +52,229 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.environ.get("DATA_DIR", os.path.join(BASE_DIR, "data"))
 DB_PATH = os.environ.get("DB_PATH", os.path.join(DATA_DIR, "app.db"))
 UPLOAD_DIR = os.environ.get("UPLOAD_DIR", os.path.join(DATA_DIR, "uploads"))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+UPLOAD_CHUNK_SIZE = 1 << 16
+ROOM_HISTORY_MAX = int(os.environ.get("ROOM_HISTORY_MAX", "500"))
+MAX_MSG_CHARS = int(os.environ.get("MAX_MSG_CHARS", str(64 * 1024)))
+SEND_QUEUE_MAX = 256
+SEND_BATCH_MAX = 64
+# typing/read are relayed live but never kept in room history
+EPHEMERAL_TYPES = frozenset({"typing", "read"})
+# identical ephemeral events from one user closer together than this are dropped
+EPHEMERAL_DEDUP_SECONDS = 0.5
+EARTH_RADIUS_KM = 6371.0
+SERVE_UPLOADS = os.environ.get("SERVE_UPLOADS", "1") == "1"
 
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 app = FastAPI()
 templates = Jinja2Templates(directory="templates")
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+if SERVE_UPLOADS:
+    # disable when a reverse proxy (nginx sendfile) serves UPLOAD_DIR directly
+    app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
 app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "static")), name="static")
 
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
-
-# Volatile, in-memory storage only for chat messages
-rooms_messages: Dict[str, List[dict]] = {}
-rooms_connections: Dict[str, Set[WebSocket]] = {}
-rooms_owner: Dict[str, str] = {}
-rooms_banned: Dict[str, Set[str]] = {}
-rooms_user_sockets: Dict[str, Dict[str, Set[WebSocket]]] = {}
-rooms_user_meta: Dict[str, Dict[str, dict]] = {}
+pwd_context = CryptContext(
+    schemes=["argon2"],
+    deprecated="auto",
+    argon2__rounds=3,
+    argon2__memory_cost=65536,
+    argon2__parallelism=1,
+)
+# argon2 is CPU bound (~100 ms per call); cap it at one hash per core, off the event loop
+argon2_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="argon2")
+
+
+@dataclass(slots=True)
+class Room:
+    owner_id: str = ""
+    # history is kept already JSON-encoded, exactly as it went out on the wire
+    messages: Deque[bytes] = field(default_factory=lambda: deque(maxlen=ROOM_HISTORY_MAX))
+    # socket -> its outgoing queue, drained by that socket's socket_sender task
+    connections: Dict[WebSocket, asyncio.Queue] = field(default_factory=dict)
+    banned: Set[str] = field(default_factory=set)
+    user_sockets: Dict[str, Set[WebSocket]] = field(default_factory=dict)
+    user_meta: Dict[str, dict] = field(default_factory=dict)
+    # (user_id, type) -> (state or msg_id, monotonic time) of the last typing/read sent
+    ephemeral_last: Dict[Tuple[str, str], Tuple[Any, float]] = field(default_factory=dict)
+
+
+# Volatile, in-memory storage only for chat rooms and their messages
+rooms: Dict[str, Room] = {}
 rooms_deleted: Set[str] = set()
 
+# session id -> user row, so authenticated requests skip the sessions/users join
+session_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+session_cache_lock = threading.Lock()
+# bumped under session_cache_lock whenever cached sessions are invalidated; a lookup that
+# read the DB before a bump must not cache what it read
+session_generation = 0
+
+
+# Process-wide pool of SQLite connections, reused across requests
+db_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=DB_POOL_SIZE)
 
-def get_db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+
+def connect_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
     return conn
 
 
-def init_db() -> None:
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            id TEXT PRIMARY KEY,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            bio TEXT DEFAULT '',
-            banner_path TEXT DEFAULT '',
-            avatar_path TEXT DEFAULT '',
-            btc_address TEXT DEFAULT '',
-            created_at TEXT NOT NULL
-        );
-        """
-    )
-    try:
-        cur.execute("ALTER TABLE users ADD COLUMN avatar_path TEXT DEFAULT ''")
-    except sqlite3.OperationalError:
-        pass
+@contextmanager
+def get_db() -> Iterator[sqlite3.Connection]:
     try:
-        cur.execute("ALTER TABLE users ADD COLUMN btc_address TEXT DEFAULT ''")
-    except sqlite3.OperationalError:
-        pass
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS sessions (
-            id TEXT PRIMARY KEY,
-            user_id TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        );
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS locations (
-            user_id TEXT PRIMARY KEY,
-            lat REAL NOT NULL,
-            lon REAL NOT NULL,
-            updated_at TEXT NOT NULL
-        );
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS blocks (
-            blocker_id TEXT NOT NULL,
-            blocked_id TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            PRIMARY KEY (blocker_id, blocked_id)
-        );
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS albums (
-            id TEXT PRIMARY KEY,
-            user_id TEXT NOT NULL,
-            caption TEXT DEFAULT '',
-            created_at TEXT NOT NULL
-        );
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS media (
-            id TEXT PRIMARY KEY,
-            album_id TEXT NOT NULL,
-            kind TEXT NOT NULL,
-            path TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        );
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS album_shares (
-            token TEXT PRIMARY KEY,
-            album_id TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            expires_at TEXT NOT NULL
-        );
-        """
-    )
+        conn = db_pool.get_nowait()
+    except queue.Empty:
+        conn = connect_db()
     try:
-        cur.execute("ALTER TABLE album_shares ADD COLUMN expires_at TEXT NOT NULL DEFAULT ''")
-    except sqlite3.OperationalError:
-        pass
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS profile_photos (
-            id TEXT PRIMARY KEY,
-            user_id TEXT NOT NULL,
-            path TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        );
-        """
-    )
-    conn.commit()
-    conn.close()
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        try:
+            db_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def table_columns(cur: sqlite3.Cursor, table: str) -> Set[str]:
+    return {r[1] for r in cur.execute(f"PRAGMA table_info({table})")}
+
+
+def init_db() -> None:
+    with get_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        cur = conn.cursor()
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id TEXT PRIMARY KEY,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                bio TEXT DEFAULT '',
+                banner_path TEXT DEFAULT '',
+                avatar_path TEXT DEFAULT '',
+                btc_address TEXT DEFAULT '',
+                created_at TEXT NOT NULL
+            );
+            """
+        )
+        user_cols = table_columns(cur, "users")
+        if "avatar_path" not in user_cols:
+            cur.execute("ALTER TABLE users ADD COLUMN avatar_path TEXT DEFAULT ''")
+        if "btc_address" not in user_cols:
+            cur.execute("ALTER TABLE users ADD COLUMN btc_address TEXT DEFAULT ''")
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            );
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS locations (
+                user_id TEXT PRIMARY KEY,
+                lat REAL NOT NULL,
+                lon REAL NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blocks (
+                blocker_id TEXT NOT NULL,
+                blocked_id TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (blocker_id, blocked_id)
+            );
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS albums (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                caption TEXT DEFAULT '',
+                created_at TEXT NOT NULL
+            );
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media (
+                id TEXT PRIMARY KEY,
+                album_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                path TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            );
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS album_shares (
+                token TEXT PRIMARY KEY,
+                album_id TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                expires_at TEXT NOT NULL
+            );
+            """
+        )
+        if "expires_at" not in table_columns(cur, "album_shares"):
+            cur.execute("ALTER TABLE album_shares ADD COLUMN expires_at TEXT NOT NULL DEFAULT ''")
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS profile_photos (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            );
+            """
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_albums_user ON albums(user_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_media_album ON media(album_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_shares_album ON album_shares(album_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_profile_photos_user ON profile_photos(user_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_blocks_blocked ON blocks(blocked_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_locations_lat ON locations(lat)")
+        cur.execute("ANALYZE")
+
+
+init_db()
 
 
-@app.on_event("startup")
-async def on_startup() -> None:
-    init_db()
+def new_id() -> str:
+    return secrets.token_hex(16)
+
+
+# (unix second, "YYYY-MM-DDTHH:MM:SS" for it), swapped as one tuple so threads never
+# see a second paired with another second's prefix
+_ts_prefix = (-1, "")
 
 
 def now_iso() -> str:
-    return datetime.utcnow().isoformat()
+    # naive UTC like datetime.utcnow().isoformat(), but the date/time part is only
+    # formatted once per second; always carries microseconds
+    global _ts_prefix
+    sec, ns = divmod(time.time_ns(), 1_000_000_000)
+    cached_sec, prefix = _ts_prefix
+    if sec != cached_sec:
+        prefix = datetime.fromtimestamp(sec, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+        _ts_prefix = (sec, prefix)
+    return f"{prefix}.{ns // 1000:06d}"
 
 
 def now_dt() -> datetime:
@@ -177,85 +288,223 @@ def parse_iso(value: str) -> Optional[datetime]:
         return None
 
 
+IMAGE_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+    "image/heic": ".heic",
+    "image/heif": ".heif",
+    "image/avif": ".avif",
+}
+
+
 def ext_from_content_type(content_type: str) -> str:
-    mapping = {
-        "image/jpeg": ".jpg",
-        "image/jpg": ".jpg",
-        "image/png": ".png",
-        "image/webp": ".webp",
-        "image/gif": ".gif",
-        "image/heic": ".heic",
-        "image/heif": ".heif",
-        "image/avif": ".avif",
-    }
-    return mapping.get(content_type.lower(), "")
+    return IMAGE_EXTENSIONS.get(content_type.lower(), "")
+
+
+def copy_upload(src: BinaryIO, dest: str) -> None:
+    with open(dest, "wb") as out:
+        shutil.copyfileobj(src, out, UPLOAD_CHUNK_SIZE)
+
 
+async def save_upload(upload: UploadFile, dest: str) -> None:
+    # stream in fixed-size chunks on a worker thread instead of buffering the whole file
+    await run_in_threadpool(copy_upload, upload.file, dest)
 
-def ensure_room(room_id: str) -> None:
-    rooms_messages.setdefault(room_id, [])
-    rooms_connections.setdefault(room_id, set())
-    rooms_banned.setdefault(room_id, set())
-    rooms_user_sockets.setdefault(room_id, {})
-    rooms_user_meta.setdefault(room_id, {})
 
+def ensure_room(room_id: str) -> Room:
+    room = rooms.get(room_id)
+    if room is None:
+        room = rooms[room_id] = Room()
+    return room
 
-async def broadcast(room_id: str, msg: dict) -> None:
-    dead = []
-    for conn in rooms_connections.get(room_id, set()):
+
+def room_owner(room_id: str) -> str:
+    room = rooms.get(room_id)
+    return room.owner_id if room else ""
+
+
+# what a send on a closed / half-closed socket raises (starlette, uvicorn)
+SOCKET_SEND_ERRORS = (WebSocketDisconnect, RuntimeError, OSError)
+
+
+def fanout(room: Room, data: bytes) -> None:
+    # hand one pre-encoded frame to every socket's sender without waiting on any peer
+    slow = set()
+    for conn, out_q in room.connections.items():
         try:
-            await conn.send_json(msg)
-        except Exception:
-            dead.append(conn)
-    for conn in dead:
-        rooms_connections[room_id].discard(conn)
+            out_q.put_nowait(data)
+        except asyncio.QueueFull:
+            slow.add(conn)
+    for conn in slow:
+        # peer can't keep up: drop what it hasn't read and let its sender close it
+        out_q = room.connections.pop(conn)
+        while not out_q.empty():
+            out_q.get_nowait()
+        out_q.put_nowait(None)
+
+
+async def close_sockets(sockets: Iterable[WebSocket], code: int) -> None:
+    # snapshot first: each close lets the socket's endpoint run leave_room()
+    conns = tuple(sockets)
+    await asyncio.gather(*(ws.close(code=code) for ws in conns), return_exceptions=True)
+
+
+def broadcast(room: Room, msg: dict) -> None:
+    fanout(room, orjson.dumps(msg))
+
+
+def is_repeat_ephemeral(room: Room, msg: dict) -> bool:
+    if msg["type"] == "typing":
+        value = msg["state"]
+    elif msg["type"] == "read":
+        value = msg["msg_id"]
+    else:
+        return False
+    key = (msg["user_id"], msg["type"])
+    now = time.monotonic()
+    last = room.ephemeral_last.get(key)
+    if last is not None and last[0] == value and now - last[1] < EPHEMERAL_DEDUP_SECONDS:
+        return True
+    room.ephemeral_last[key] = (value, now)
+    return False
+
+
+async def socket_sender(room: Room, ws: WebSocket, out_q: asyncio.Queue) -> None:
+    # the only task that writes to ws; None in the queue means the peer was evicted.
+    # Whatever piled up while the last send was in flight goes out as one batch frame.
+    try:
+        while True:
+            data = await out_q.get()
+            if data is None:
+                await ws.close(code=1013)
+                return
+            batch = [data]
+            # fanout empties the queue before queueing None, so it can only come first
+            while len(batch) < SEND_BATCH_MAX and not out_q.empty():
+                batch.append(out_q.get_nowait())
+            if len(batch) > 1:
+                data = b'{"type":"batch","items":[' + b",".join(batch) + b"]}"
+            await ws.send_bytes(data)
+    except SOCKET_SEND_ERRORS:
+        pass
+    finally:
+        room.connections.pop(ws, None)
+
 
+def cached_session_user(session_id: str) -> Optional[dict]:
+    with session_cache_lock:
+        return session_cache.get(session_id)
 
-def get_session_user(request: Request) -> Optional[sqlite3.Row]:
+
+def lookup_session_user(session_id: str) -> Optional[dict]:
+    with session_cache_lock:
+        user = session_cache.get(session_id)
+        generation = session_generation
+    if user is not None:
+        return user
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT users.id, users.username, users.avatar_path, users.banner_path FROM sessions
+            JOIN users ON users.id = sessions.user_id
+            WHERE sessions.id = ?
+            """,
+            (session_id,),
+        )
+        row = cur.fetchone()
+    if not row:
+        return None
+    user = dict(row)
+    with session_cache_lock:
+        # a logout or profile change since our read may have made this row stale
+        if generation == session_generation:
+            session_cache[session_id] = user
+    return user
+
+
+def get_session_user(request: Request) -> Optional[dict]:
     session_id = request.cookies.get("session")
     if not session_id:
         return None
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT users.* FROM sessions
-        JOIN users ON users.id = sessions.user_id
-        WHERE sessions.id = ?
-        """,
-        (session_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return lookup_session_user(session_id)
+
+
+def get_session_user_full(request: Request) -> Optional[dict]:
+    user = get_session_user(request)
+    if not user:
+        return None
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, username, bio, banner_path, avatar_path, btc_address, created_at
+            FROM users WHERE id = ?
+            """,
+            (user["id"],),
+        )
+        row = cur.fetchone()
+    return dict(row) if row else None
+
+
+def invalidate_sessions() -> None:
+    # caller holds session_cache_lock
+    global session_generation
+    session_generation += 1
+
+
+def forget_user_sessions(user_id: str) -> None:
+    with session_cache_lock:
+        invalidate_sessions()
+        stale = [sid for sid, user in session_cache.items() if user["id"] == user_id]
+        for sid in stale:
+            session_cache.pop(sid, None)
 
 
-def require_user(request: Request) -> sqlite3.Row:
+def require_user(request: Request) -> dict:
     user = get_session_user(request)
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
     return user
 
 
-def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    r = 6371.0
-    d_lat = math.radians(lat2 - lat1)
-    d_lon = math.radians(lon2 - lon1)
+def haversine_rad(lat1: float, lon1: float, cos_lat1: float, lat2: float, lon2: float) -> float:
+    # coordinates in radians; cos_lat1 is passed in so callers can hoist it out of loops
     a = (
-        math.sin(d_lat / 2) ** 2
-        + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_lon / 2) ** 2
+        math.sin((lat2 - lat1) / 2) ** 2
+        + cos_lat1 * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
     )
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return r * c
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat: float, lon: float, radius_km: float) -> tuple:
+    # exact lat/lon extent of the circle haversine_rad measures, so the box never clips it
+    ang = radius_km / EARTH_RADIUS_KM
+    d_lat = math.degrees(ang)
+    lat_min, lat_max = lat - d_lat, lat + d_lat
+    sin_ang = math.sin(ang)
+    cos_lat = math.cos(math.radians(lat))
+    if lat_min <= -90.0 or lat_max >= 90.0 or sin_ang >= cos_lat:
+        # the circle contains a pole, so it reaches every longitude
+        return lat_min, lat_max, -180.0, 180.0
+    d_lon = math.degrees(math.asin(sin_ang / cos_lat))
+    if abs(lon) + d_lon > 180.0:
+        # box crosses the antimeridian: only filter by latitude
+        return lat_min, lat_max, -180.0, 180.0
+    return lat_min, lat_max, lon - d_lon, lon + d_lon
 
 
 @app.get("/")
-async def home(request: Request):
+def home(request: Request):
     user = get_session_user(request)
     if user:
         return RedirectResponse(url="/app")
     # lightweight captcha (simple math)
-    a = uuid.uuid4().int % 9 + 1
-    b = (uuid.uuid4().int // 10) % 9 + 1
+    a = random.randint(1, 9)
+    b = random.randint(1, 9)
     answer = str(a + b)
     resp = templates.TemplateResponse(
         "index.html",
@@ -266,8 +515,8 @@ async def home(request: Request):
 
 
 @app.get("/app")
-async def app_home(request: Request):
-    user = get_session_user(request)
+def app_home(request: Request):
+    user = get_session_user_full(request)
     if not user:
         return RedirectResponse(url="/")
     return templates.TemplateResponse(
@@ -275,12 +524,48 @@ async def app_home(request: Request):
         {
             "request": request,
             "mode": "app",
-            "user": dict(user),
+            "user": user,
             "open_profile": request.query_params.get("profile") == "1",
         },
     )
 
 
+async def hash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(argon2_pool, pwd_context.hash, password)
+
+
+async def verify_password(password: str, password_hash: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(argon2_pool, pwd_context.verify, password, password_hash)
+
+
+def insert_user(user_id: str, username: str, password_hash: str) -> None:
+    with get_db() as conn:
+        conn.execute(
+            """
+            INSERT INTO users (id, username, password_hash, created_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            (user_id, username, password_hash, now_iso()),
+        )
+
+
+def get_login_user(username: str) -> Optional[sqlite3.Row]:
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,))
+        return cur.fetchone()
+
+
+def insert_session(session_id: str, user_id: str) -> None:
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO sessions (id, user_id, created_at) VALUES (?, ?, ?)",
+            (session_id, user_id, now_iso()),
+        )
+
+
 @app.post("/auth/register")
 async def register(
     request: Request,
@@ -290,22 +575,12 @@ async def register(
 ):
     if captcha.strip() != (request.cookies.get("captcha_answer") or ""):
         raise HTTPException(status_code=400, detail="Invalid captcha")
-    conn = get_db()
-    cur = conn.cursor()
-    user_id = str(uuid.uuid4())
+    user_id = new_id()
+    password_hash = await hash_password(password)
     try:
-        cur.execute(
-            """
-            INSERT INTO users (id, username, password_hash, created_at)
-            VALUES (?, ?, ?, ?)
-            """,
-            (user_id, username, pwd_context.hash(password), now_iso()),
-        )
-        conn.commit()
+        await run_in_threadpool(insert_user, user_id, username, password_hash)
     except sqlite3.IntegrityError:
-        conn.close()
         raise HTTPException(status_code=400, detail="Username already exists")
-    conn.close()
     return RedirectResponse(url="/", status_code=303)
 
 
@@ -318,21 +593,12 @@ async def login(
 ):
     if captcha.strip() != (request.cookies.get("captcha_answer") or ""):
         raise HTTPException(status_code=400, detail="Invalid captcha")
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE username = ?", (username,))
-    user = cur.fetchone()
-    if not user or not pwd_context.verify(password, user["password_hash"]):
-        conn.close()
+    user = await run_in_threadpool(get_login_user, username)
+    if not user or not await verify_password(password, user["password_hash"]):
         raise HTTPException(status_code=400, detail="Invalid credentials")
 
-    session_id = str(uuid.uuid4())
-    cur.execute(
-        "INSERT INTO sessions (id, user_id, created_at) VALUES (?, ?, ?)",
-        (session_id, user["id"], now_iso()),
-    )
-    conn.commit()
-    conn.close()
+    session_id = new_id()
+    await run_in_threadpool(insert_session, session_id, user["id"])
 
     resp = RedirectResponse(url="/app", status_code=303)
     resp.set_cookie("session", session_id, httponly=True)
@@ -340,19 +606,37 @@ async def login(
 
 
 @app.post("/auth/logout")
-async def logout(request: Request):
+def logout(request: Request):
     session_id = request.cookies.get("session")
     if session_id:
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
-        conn.commit()
-        conn.close()
+        with get_db() as conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        with session_cache_lock:
+            invalidate_sessions()
+            session_cache.pop(session_id, None)
     resp = RedirectResponse(url="/", status_code=303)
     resp.delete_cookie("session")
     return resp
 
 
+def save_profile(
+    user: dict, username: str, bio: str, banner_path: str, avatar_path: str, btc: str
+) -> None:
+    with get_db() as conn:
+        cur = conn.cursor()
+        if username and username != user["username"]:
+            cur.execute(
+                "SELECT 1 FROM users WHERE username = ? AND id != ?", (username, user["id"])
+            )
+            if cur.fetchone():
+                raise HTTPException(status_code=400, detail="Username already exists")
+        cur.execute(
+            "UPDATE users SET username = ?, bio = ?, banner_path = ?, avatar_path = ?, btc_address = ? WHERE id = ?",
+            (username or user["username"], bio, banner_path, avatar_path, btc, user["id"]),
+        )
+    forget_user_sessions(user["id"])
+
+
 @app.post("/me/profile")
 async def update_profile(
     request: Request,
@@ -362,7 +646,7 @@ async def update_profile(
     banner: UploadFile = File(None),
     avatar: UploadFile = File(None),
 ):
-    user = require_user(request)
+    user = await run_in_threadpool(require_user, request)
     banner_path = user["banner_path"]
     avatar_path = user["avatar_path"]
     btc = btc_address.strip()
@@ -371,163 +655,143 @@ async def update_profile(
         ext = os.path.splitext(banner.filename or "")[1].lower()
         if not ext:
             ext = ext_from_content_type(banner.content_type or "")
-        filename = f"banner-{user['id']}-{uuid.uuid4().hex}{ext}"
+        filename = f"banner-{user['id']}-{new_id()}{ext}"
         dest = os.path.join(UPLOAD_DIR, filename)
-        with open(dest, "wb") as f:
-            f.write(await banner.read())
+        await save_upload(banner, dest)
         banner_path = f"/uploads/{filename}"
     if avatar is not None:
         ext = os.path.splitext(avatar.filename or "")[1].lower()
         if not ext:
             ext = ext_from_content_type(avatar.content_type or "")
-        filename = f"avatar-{user['id']}-{uuid.uuid4().hex}{ext}"
+        filename = f"avatar-{user['id']}-{new_id()}{ext}"
         dest = os.path.join(UPLOAD_DIR, filename)
-        with open(dest, "wb") as f:
-            f.write(await avatar.read())
+        await save_upload(avatar, dest)
         avatar_path = f"/uploads/{filename}"
 
-    conn = get_db()
-    cur = conn.cursor()
-    if username and username != user["username"]:
-        cur.execute("SELECT 1 FROM users WHERE username = ? AND id != ?", (username, user["id"]))
-        if cur.fetchone():
-            conn.close()
-            raise HTTPException(status_code=400, detail="Username already exists")
-    cur.execute(
-        "UPDATE users SET username = ?, bio = ?, banner_path = ?, avatar_path = ?, btc_address = ? WHERE id = ?",
-        (username or user["username"], bio, banner_path, avatar_path, btc, user["id"]),
-    )
-    conn.commit()
-    conn.close()
+    await run_in_threadpool(save_profile, user, username, bio, banner_path, avatar_path, btc)
     return RedirectResponse(url="/app?profile=1", status_code=303)
 
 
 @app.get("/me/photos")
-async def list_profile_photos(request: Request):
+def list_profile_photos(request: Request):
     user = require_user(request)
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, path FROM profile_photos WHERE user_id = ? ORDER BY created_at DESC",
-        (user["id"],),
-    )
-    photos = [dict(r) for r in cur.fetchall()]
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT id, path FROM profile_photos WHERE user_id = ? ORDER BY created_at DESC",
+            (user["id"],),
+        )
+        photos = [dict(r) for r in cur.fetchall()]
     return {"photos": photos}
 
 
+def insert_profile_photos(rows: List[tuple]) -> None:
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO profile_photos (id, user_id, path, created_at) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+
+
 @app.post("/me/photos")
 async def upload_profile_photos(request: Request, files: List[UploadFile] = File(...)):
-    user = require_user(request)
-    conn = get_db()
-    cur = conn.cursor()
+    user = await run_in_threadpool(require_user, request)
+    rows = []
     for f in files:
         if not (f.content_type or "").startswith("image/"):
             continue
         ext = os.path.splitext(f.filename or "")[1].lower()
-        photo_id = str(uuid.uuid4())
+        photo_id = new_id()
         filename = f"profile-{user['id']}-{photo_id}{ext}"
         dest = os.path.join(UPLOAD_DIR, filename)
-        with open(dest, "wb") as out:
-            out.write(await f.read())
-        cur.execute(
-            "INSERT INTO profile_photos (id, user_id, path, created_at) VALUES (?, ?, ?, ?)",
-            (photo_id, user["id"], f"/uploads/{filename}", now_iso()),
-        )
-    conn.commit()
-    conn.close()
+        await save_upload(f, dest)
+        rows.append((photo_id, user["id"], f"/uploads/{filename}", now_iso()))
+    await run_in_threadpool(insert_profile_photos, rows)
     return RedirectResponse(url="/app?profile=1", status_code=303)
 
 
 @app.post("/me/photos/delete/{photo_id}")
-async def delete_profile_photo(request: Request, photo_id: str):
+def delete_profile_photo(request: Request, photo_id: str):
     user = require_user(request)
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT path FROM profile_photos WHERE id = ? AND user_id = ?",
-        (photo_id, user["id"]),
-    )
-    row = cur.fetchone()
-    if row:
-        path = row["path"]
+    with get_db() as conn:
+        cur = conn.cursor()
         cur.execute(
-            "DELETE FROM profile_photos WHERE id = ? AND user_id = ?", (photo_id, user["id"])
+            "SELECT path FROM profile_photos WHERE id = ? AND user_id = ?",
+            (photo_id, user["id"]),
         )
-        try:
-            if path.startswith("/uploads/"):
-                os.remove(os.path.join(UPLOAD_DIR, path.replace("/uploads/", "")))
-        except Exception:
-            pass
-    conn.commit()
-    conn.close()
+        row = cur.fetchone()
+        if row:
+            path = row["path"]
+            cur.execute(
+                "DELETE FROM profile_photos WHERE id = ? AND user_id = ?", (photo_id, user["id"])
+            )
+            try:
+                if path.startswith("/uploads/"):
+                    os.remove(os.path.join(UPLOAD_DIR, path.replace("/uploads/", "")))
+            except Exception:
+                pass
     return {"ok": True}
 
 
 @app.post("/me/location")
-async def update_location(
+def update_location(
     request: Request,
     lat: float = Form(...),
     lon: float = Form(...),
 ):
     user = require_user(request)
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO locations (user_id, lat, lon, updated_at)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            lat = excluded.lat,
-            lon = excluded.lon,
-            updated_at = excluded.updated_at
-        """,
-        (user["id"], lat, lon, now_iso()),
-    )
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute(
+            """
+            INSERT INTO locations (user_id, lat, lon, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                lat = excluded.lat,
+                lon = excluded.lon,
+                updated_at = excluded.updated_at
+            """,
+            (user["id"], lat, lon, now_iso()),
+        )
     return {"ok": True}
 
 
 @app.get("/users/nearby")
-async def nearby_users(request: Request, radius_km: float = 5.0):
+def nearby_users(request: Request, radius_km: float = 5.0):
     user = require_user(request)
-    conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute("SELECT lat, lon FROM locations WHERE user_id = ?", (user["id"],))
-    me_loc = cur.fetchone()
-    if not me_loc:
-        conn.close()
-        return {"users": []}
-
-    cur.execute(
-        """
-        SELECT users.id, users.username, users.bio, users.banner_path, users.avatar_path, locations.lat, locations.lon
-        FROM locations
-        JOIN users ON users.id = locations.user_id
-        WHERE users.id != ?
-        """,
-        (user["id"],),
-    )
-    rows = cur.fetchall()
+    with get_db() as conn:
+        cur = conn.cursor()
 
-    cur.execute(
-        "SELECT blocked_id FROM blocks WHERE blocker_id = ?",
-        (user["id"],),
-    )
-    blocked_out = {r["blocked_id"] for r in cur.fetchall()}
-    cur.execute(
-        "SELECT blocker_id FROM blocks WHERE blocked_id = ?",
-        (user["id"],),
-    )
-    blocked_in = {r["blocker_id"] for r in cur.fetchall()}
+        cur.execute("SELECT lat, lon FROM locations WHERE user_id = ?", (user["id"],))
+        me_loc = cur.fetchone()
+        if not me_loc:
+            return {"users": []}
+
+        lat_min, lat_max, lon_min, lon_max = bounding_box(me_loc["lat"], me_loc["lon"], radius_km)
+        cur.execute(
+            """
+            SELECT users.id, users.username, users.bio, users.banner_path, users.avatar_path, locations.lat, locations.lon
+            FROM locations
+            JOIN users ON users.id = locations.user_id
+            WHERE users.id != ?
+            AND locations.lat BETWEEN ? AND ?
+            AND locations.lon BETWEEN ? AND ?
+            AND users.id NOT IN (
+                SELECT blocked_id FROM blocks WHERE blocker_id = ?
+                UNION
+                SELECT blocker_id FROM blocks WHERE blocked_id = ?
+            )
+            """,
+            (user["id"], lat_min, lat_max, lon_min, lon_max, user["id"], user["id"]),
+        )
+        rows = cur.fetchall()
 
+    me_lat = math.radians(me_loc["lat"])
+    me_lon = math.radians(me_loc["lon"])
+    cos_me = math.cos(me_lat)
     results = []
     for r in rows:
-        if r["id"] in blocked_out or r["id"] in blocked_in:
-            continue
-        dist = haversine_km(me_loc["lat"], me_loc["lon"], r["lat"], r["lon"])
+        dist = haversine_rad(me_lat, me_lon, cos_me, math.radians(r["lat"]), math.radians(r["lon"]))
         if dist <= radius_km:
             results.append(
                 {
@@ -540,99 +804,110 @@ async def nearby_users(request: Request, radius_km: float = 5.0):
                 }
             )
 
-    conn.close()
     results.sort(key=lambda x: x["distance"])
     return {"users": results}
 
 
 @app.post("/block/{user_id}")
-async def block_user(request: Request, user_id: str):
+def block_user(request: Request, user_id: str):
     user = require_user(request)
     if user_id == user["id"]:
         raise HTTPException(status_code=400, detail="Cannot block self")
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR IGNORE INTO blocks (blocker_id, blocked_id, created_at) VALUES (?, ?, ?)",
-        (user["id"], user_id, now_iso()),
-    )
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO blocks (blocker_id, blocked_id, created_at) VALUES (?, ?, ?)",
+            (user["id"], user_id, now_iso()),
+        )
     return {"ok": True}
 
 
+def insert_album(album: tuple, media: List[tuple]) -> None:
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT INTO albums (id, user_id, caption, created_at) VALUES (?, ?, ?, ?)",
+            album,
+        )
+        conn.executemany(
+            "INSERT INTO media (id, album_id, kind, path, created_at) VALUES (?, ?, ?, ?, ?)",
+            media,
+        )
+
+
 @app.post("/albums")
 async def create_album(
     request: Request,
     caption: str = Form(""),
     files: List[UploadFile] = File(...),
 ):
-    user = require_user(request)
-    album_id = str(uuid.uuid4())
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO albums (id, user_id, caption, created_at) VALUES (?, ?, ?, ?)",
-        (album_id, user["id"], caption, now_iso()),
-    )
+    user = await run_in_threadpool(require_user, request)
+    album_id = new_id()
+    album = (album_id, user["id"], caption, now_iso())
 
+    media = []
+    writes = []
     for f in files:
         content_type = f.content_type or "application/octet-stream"
         ext = os.path.splitext(f.filename or "")[1].lower()
-        media_id = str(uuid.uuid4())
+        media_id = new_id()
         filename = f"{media_id}{ext}"
         dest = os.path.join(UPLOAD_DIR, filename)
-        with open(dest, "wb") as out:
-            out.write(await f.read())
-        cur.execute(
-            "INSERT INTO media (id, album_id, kind, path, created_at) VALUES (?, ?, ?, ?, ?)",
-            (media_id, album_id, content_type, f"/uploads/{filename}", now_iso()),
-        )
+        writes.append(save_upload(f, dest))
+        media.append((media_id, album_id, content_type, f"/uploads/{filename}", now_iso()))
+    # write all files concurrently on the threadpool
+    await asyncio.gather(*writes)
 
-    conn.commit()
-    conn.close()
+    await run_in_threadpool(insert_album, album, media)
     return RedirectResponse(url="/app", status_code=303)
 
 
 @app.get("/albums/me")
-async def my_albums(request: Request):
+def my_albums(request: Request):
     user = require_user(request)
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT * FROM albums WHERE user_id = ? ORDER BY created_at DESC",
-        (user["id"],),
-    )
-    albums = []
-    for a in cur.fetchall():
+    with get_db() as conn:
+        cur = conn.cursor()
         cur.execute(
-            "SELECT * FROM media WHERE album_id = ? ORDER BY created_at ASC",
-            (a["id"],),
-        )
-        albums.append(
-            {
-                "id": a["id"],
-                "caption": a["caption"],
-                "media": [dict(m) for m in cur.fetchall()],
-            }
+            """
+            SELECT albums.id, albums.caption,
+                   media.id AS media_id, media.kind, media.path, media.created_at
+            FROM albums
+            LEFT JOIN media ON media.album_id = albums.id
+            WHERE albums.user_id = ?
+            ORDER BY albums.created_at DESC, albums.id, media.created_at ASC
+            """,
+            (user["id"],),
         )
-    conn.close()
-    return {"albums": albums}
+        rows = cur.fetchall()
+
+    albums: Dict[str, dict] = {}
+    for r in rows:
+        album = albums.get(r["id"])
+        if album is None:
+            album = albums[r["id"]] = {"id": r["id"], "caption": r["caption"], "media": []}
+        if r["media_id"] is not None:
+            album["media"].append(
+                {
+                    "id": r["media_id"],
+                    "album_id": r["id"],
+                    "kind": r["kind"],
+                    "path": r["path"],
+                    "created_at": r["created_at"],
+                }
+            )
+    return {"albums": list(albums.values())}
 
 
 @app.get("/album/{album_id}")
-async def view_album(request: Request, album_id: str):
+def view_album(request: Request, album_id: str):
     user = require_user(request)
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM albums WHERE id = ? AND user_id = ?", (album_id, user["id"]))
-    album = cur.fetchone()
-    if not album:
-        conn.close()
-        return RedirectResponse(url="/app")
-    cur.execute("SELECT * FROM media WHERE album_id = ? ORDER BY created_at ASC", (album_id,))
-    media = [dict(m) for m in cur.fetchall()]
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM albums WHERE id = ? AND user_id = ?", (album_id, user["id"]))
+        album = cur.fetchone()
+        if not album:
+            return RedirectResponse(url="/app")
+        cur.execute("SELECT * FROM media WHERE album_id = ? ORDER BY created_at ASC", (album_id,))
+        media = [dict(m) for m in cur.fetchall()]
     return templates.TemplateResponse(
         "index.html",
         {
@@ -646,104 +921,91 @@ async def view_album(request: Request, album_id: str):
 
 
 @app.post("/album/{album_id}/share")
-async def share_album(request: Request, album_id: str, ttl_hours: int = 24):
+def share_album(request: Request, album_id: str, ttl_hours: int = 24):
     user = require_user(request)
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM albums WHERE id = ? AND user_id = ?", (album_id, user["id"]))
-    if not cur.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Album not found")
-    if ttl_hours not in {1, 24, 168}:
-        conn.close()
-        raise HTTPException(status_code=400, detail="Invalid ttl")
-    token = str(uuid.uuid4())
-    expires_at = (now_dt() + timedelta(hours=ttl_hours)).isoformat()
-    cur.execute(
-        "INSERT INTO album_shares (token, album_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
-        (token, album_id, now_iso(), expires_at),
-    )
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM albums WHERE id = ? AND user_id = ?", (album_id, user["id"]))
+        if not cur.fetchone():
+            raise HTTPException(status_code=404, detail="Album not found")
+        if ttl_hours not in {1, 24, 168}:
+            raise HTTPException(status_code=400, detail="Invalid ttl")
+        token = new_id()
+        expires_at = (now_dt() + timedelta(hours=ttl_hours)).isoformat()
+        cur.execute(
+            "INSERT INTO album_shares (token, album_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+            (token, album_id, now_iso(), expires_at),
+        )
     return {"token": token, "expires_at": expires_at}
 
 
 @app.get("/album/{album_id}/shares")
-async def list_album_shares(request: Request, album_id: str):
+def list_album_shares(request: Request, album_id: str):
     user = require_user(request)
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM albums WHERE id = ? AND user_id = ?", (album_id, user["id"]))
-    if not cur.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Album not found")
-    cur.execute(
-        "SELECT token, created_at, expires_at FROM album_shares WHERE album_id = ? ORDER BY created_at DESC",
-        (album_id,),
-    )
-    shares = [dict(r) for r in cur.fetchall()]
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM albums WHERE id = ? AND user_id = ?", (album_id, user["id"]))
+        if not cur.fetchone():
+            raise HTTPException(status_code=404, detail="Album not found")
+        cur.execute(
+            "SELECT token, created_at, expires_at FROM album_shares WHERE album_id = ? ORDER BY created_at DESC",
+            (album_id,),
+        )
+        shares = [dict(r) for r in cur.fetchall()]
     return {"shares": shares}
 
 
 @app.post("/album/share/revoke/{token}")
-async def revoke_share_token(request: Request, token: str):
+def revoke_share_token(request: Request, token: str):
     user = require_user(request)
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT albums.id AS album_id FROM album_shares
-        JOIN albums ON albums.id = album_shares.album_id
-        WHERE album_shares.token = ? AND albums.user_id = ?
-        """,
-        (token, user["id"]),
-    )
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Token not found")
-    cur.execute("DELETE FROM album_shares WHERE token = ?", (token,))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT albums.id AS album_id FROM album_shares
+            JOIN albums ON albums.id = album_shares.album_id
+            WHERE album_shares.token = ? AND albums.user_id = ?
+            """,
+            (token, user["id"]),
+        )
+        row = cur.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Token not found")
+        cur.execute("DELETE FROM album_shares WHERE token = ?", (token,))
     return {"ok": True}
 
 
 @app.post("/album/{album_id}/revoke")
-async def revoke_album_shares(request: Request, album_id: str):
+def revoke_album_shares(request: Request, album_id: str):
     user = require_user(request)
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM albums WHERE id = ? AND user_id = ?", (album_id, user["id"]))
-    if not cur.fetchone():
-        conn.close()
-        raise HTTPException(status_code=404, detail="Album not found")
-    cur.execute("DELETE FROM album_shares WHERE album_id = ?", (album_id,))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM albums WHERE id = ? AND user_id = ?", (album_id, user["id"]))
+        if not cur.fetchone():
+            raise HTTPException(status_code=404, detail="Album not found")
+        cur.execute("DELETE FROM album_shares WHERE album_id = ?", (album_id,))
     return {"ok": True}
 
 
 @app.get("/album/shared/{token}")
-async def view_shared_album(request: Request, token: str):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT albums.*, album_shares.expires_at FROM album_shares JOIN albums ON albums.id = album_shares.album_id WHERE album_shares.token = ?",
-        (token,),
-    )
-    album = cur.fetchone()
-    if not album:
-        conn.close()
-        return RedirectResponse(url="/")
-    if album["expires_at"]:
-        exp = parse_iso(album["expires_at"])
-        if exp and exp < now_dt():
-            conn.close()
+def view_shared_album(request: Request, token: str):
+    with get_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT albums.*, album_shares.expires_at FROM album_shares JOIN albums ON albums.id = album_shares.album_id WHERE album_shares.token = ?",
+            (token,),
+        )
+        album = cur.fetchone()
+        if not album:
             return RedirectResponse(url="/")
-    cur.execute("SELECT * FROM media WHERE album_id = ? ORDER BY created_at ASC", (album["id"],))
-    media = [dict(m) for m in cur.fetchall()]
-    conn.close()
+        if album["expires_at"]:
+            exp = parse_iso(album["expires_at"])
+            if exp and exp < now_dt():
+                return RedirectResponse(url="/")
+        cur.execute(
+            "SELECT * FROM media WHERE album_id = ? ORDER BY created_at ASC", (album["id"],)
+        )
+        media = [dict(m) for m in cur.fetchall()]
     return templates.TemplateResponse(
         "index.html",
         {
@@ -758,16 +1020,16 @@ async def view_shared_album(request: Request, token: str):
 
 @app.get("/new")
 async def new_room(request: Request):
-    user = require_user(request)
-    room_id = str(uuid.uuid4())
+    user = await run_in_threadpool(require_user, request)
+    room_id = new_id()
     rooms_deleted.discard(room_id)
-    rooms_owner[room_id] = user["id"]
+    rooms[room_id] = Room(owner_id=user["id"])
     return RedirectResponse(url=f"/room/{room_id}")
 
 
 @app.get("/room/{room_id}")
 async def chat_room(request: Request, room_id: str):
-    require_user(request)
+    await run_in_threadpool(require_user, request)
     try:
         uuid.UUID(room_id)
     except ValueError:
@@ -776,70 +1038,52 @@ async def chat_room(request: Request, room_id: str):
     if room_id in rooms_deleted:
         return RedirectResponse(url="/app")
 
-    ensure_room(room_id)
+    room = ensure_room(room_id)
     return templates.TemplateResponse(
         "index.html",
         {
             "request": request,
             "mode": "chat",
             "room_id": room_id,
-            "room_owner_id": rooms_owner.get(room_id, ""),
+            "room_owner_id": room.owner_id,
         },
     )
 
 
 @app.post("/destroy/{room_id}")
 async def destroy_room(request: Request, room_id: str):
-    user = require_user(request)
-    owner_id = rooms_owner.get(room_id)
+    user = await run_in_threadpool(require_user, request)
+    owner_id = room_owner(room_id)
     if owner_id and owner_id != user["id"]:
         raise HTTPException(status_code=403, detail="Only owner can destroy this room")
-    conns = rooms_connections.get(room_id, set())
-    for ws in list(conns):
-        try:
-            await ws.close(code=1000)
-        except Exception:
-            pass
-    rooms_connections.pop(room_id, None)
-    rooms_messages.pop(room_id, None)
-    rooms_owner.pop(room_id, None)
-    rooms_banned.pop(room_id, None)
-    rooms_user_sockets.pop(room_id, None)
-    rooms_user_meta.pop(room_id, None)
+    room = rooms.get(room_id)
+    if room:
+        await close_sockets(room.connections, 1000)
+    rooms.pop(room_id, None)
     rooms_deleted.add(room_id)
     return {"ok": True}
 
 
 @app.post("/room/{room_id}/kick/{user_id}")
 async def kick_user(request: Request, room_id: str, user_id: str):
-    user = require_user(request)
-    owner_id = rooms_owner.get(room_id)
+    user = await run_in_threadpool(require_user, request)
+    owner_id = room_owner(room_id)
     if owner_id and owner_id != user["id"]:
         raise HTTPException(status_code=403, detail="Only owner can kick/ban")
-    ensure_room(room_id)
-    conns = rooms_user_sockets.get(room_id, {}).get(user_id, set())
-    for ws in list(conns):
-        try:
-            await ws.close(code=4000)
-        except Exception:
-            pass
+    room = ensure_room(room_id)
+    await close_sockets(room.user_sockets.get(user_id, ()), 4000)
     return {"ok": True}
 
 
 @app.post("/room/{room_id}/ban/{user_id}")
 async def ban_user(request: Request, room_id: str, user_id: str):
-    user = require_user(request)
-    owner_id = rooms_owner.get(room_id)
+    user = await run_in_threadpool(require_user, request)
+    owner_id = room_owner(room_id)
     if owner_id and owner_id != user["id"]:
         raise HTTPException(status_code=403, detail="Only owner can kick/ban")
-    ensure_room(room_id)
-    rooms_banned[room_id].add(user_id)
-    conns = rooms_user_sockets.get(room_id, {}).get(user_id, set())
-    for ws in list(conns):
-        try:
-            await ws.close(code=4003)
-        except Exception:
-            pass
+    room = ensure_room(room_id)
+    room.banned.add(user_id)
+    await close_sockets(room.user_sockets.get(user_id, ()), 4003)
     return {"ok": True}
 
 
@@ -849,7 +1093,7 @@ async def upload_room_media(
     room_id: str,
     files: List[UploadFile] = File(...),
 ):
-    user = require_user(request)
+    user = await run_in_threadpool(require_user, request)
     try:
         uuid.UUID(room_id)
     except ValueError:
@@ -859,11 +1103,10 @@ async def upload_room_media(
     for f in files:
         content_type = f.content_type or "application/octet-stream"
         ext = os.path.splitext(f.filename or "")[1].lower()
-        media_id = str(uuid.uuid4())
+        media_id = new_id()
         filename = f"room-{room_id}-{media_id}{ext}"
         dest = os.path.join(UPLOAD_DIR, filename)
-        with open(dest, "wb") as out:
-            out.write(await f.read())
+        await save_upload(f, dest)
         uploaded.append(
             {
                 "type": "media",
@@ -880,13 +1123,13 @@ async def upload_room_media(
 
 @app.get("/room/{room_id}/online")
 async def room_online(request: Request, room_id: str):
-    require_user(request)
-    owner = rooms_owner.get(room_id)
-    if not owner:
+    await run_in_threadpool(require_user, request)
+    room = rooms.get(room_id)
+    if not room or not room.owner_id:
         raise HTTPException(status_code=404, detail="Room not found")
     users = []
-    meta = rooms_user_meta.get(room_id, {})
-    for uid, sockets in rooms_user_sockets.get(room_id, {}).items():
+    meta = room.user_meta
+    for uid, sockets in room.user_sockets.items():
         if sockets:
             info = meta.get(uid, {"username": uid, "avatar": ""})
             users.append(
@@ -895,6 +1138,132 @@ async def room_online(request: Request, room_id: str):
     return {"users": users}
 
 
+def build_message(payload: dict, author: dict, ts: str) -> dict:
+    get = payload.get
+    return {
+        "type": "message",
+        "text": get("text", ""),
+        "enc": get("enc", False),
+        "ct": get("ct", ""),
+        "iv": get("iv", ""),
+        "salt": get("salt", ""),
+        "msg_id": get("msg_id", ""),
+        **author,
+        "ts": ts,
+    }
+
+
+def build_media(payload: dict, author: dict, ts: str) -> dict:
+    get = payload.get
+    return {
+        "type": "media",
+        "url": get("url", ""),
+        "kind": get("kind", "application/octet-stream"),
+        "enc": get("enc", False),
+        "iv": get("iv", ""),
+        "salt": get("salt", ""),
+        "orig_kind": get("orig_kind", ""),
+        "msg_id": get("msg_id", ""),
+        **author,
+        "ts": ts,
+    }
+
+
+def build_album(payload: dict, author: dict, ts: str) -> dict:
+    get = payload.get
+    return {
+        "type": "album",
+        "url": get("url", ""),
+        "title": get("title", ""),
+        "enc": get("enc", False),
+        "ct": get("ct", ""),
+        "iv": get("iv", ""),
+        "salt": get("salt", ""),
+        "msg_id": get("msg_id", ""),
+        **author,
+        "ts": ts,
+    }
+
+
+def build_location(payload: dict, author: dict, ts: str) -> dict:
+    get = payload.get
+    if get("enc"):
+        return {
+            "type": "location",
+            "enc": True,
+            "ct": get("ct", ""),
+            "iv": get("iv", ""),
+            "salt": get("salt", ""),
+            "msg_id": get("msg_id", ""),
+            **author,
+            "ts": ts,
+        }
+    return {
+        "type": "location",
+        "lat": float(get("lat", 0)),
+        "lon": float(get("lon", 0)),
+        "msg_id": get("msg_id", ""),
+        **author,
+        "ts": ts,
+    }
+
+
+def build_typing(payload: dict, author: dict, ts: str) -> dict:
+    return {
+        "type": "typing",
+        "state": bool(payload.get("state", False)),
+        "user_id": author["user_id"],
+        "username": author["username"],
+        "ts": ts,
+    }
+
+
+def build_read(payload: dict, author: dict, ts: str) -> dict:
+    return {
+        "type": "read",
+        "msg_id": payload.get("msg_id", ""),
+        "user_id": author["user_id"],
+        "username": author["username"],
+        "ts": ts,
+    }
+
+
+def build_plain(data: str, author: dict, ts: str) -> dict:
+    return {
+        "type": "message",
+        "text": data,
+        "enc": False,
+        **author,
+        "ts": ts,
+    }
+
+
+# Builders take the parsed payload, the connection's author fields (user_id,
+# username, avatar; bound once at connect) and the frame's timestamp.
+# websocket payload "type" -> builder for the outgoing room message
+MESSAGE_BUILDERS: Dict[str, Callable[[dict, dict, str], dict]] = {
+    "message": build_message,
+    "media": build_media,
+    "album": build_album,
+    "location": build_location,
+    "typing": build_typing,
+    "read": build_read,
+}
+
+
+def leave_room(room: Room, ws: WebSocket, uid: str, uname: str) -> None:
+    # single teardown path for a socket, however its connection ended
+    room.connections.pop(ws, None)
+    sockets = room.user_sockets.get(uid)
+    if sockets is not None:
+        sockets.discard(ws)
+        if sockets:
+            return
+        room.user_sockets.pop(uid, None)
+    room.user_meta.pop(uid, None)
+    broadcast(room, {"type": "system", "text": f"{uname} saiu da sala", "ts": now_iso()})
+
+
 @app.websocket("/ws/{room_id}")
 async def websocket_endpoint(ws: WebSocket, room_id: str):
     await ws.accept()
@@ -904,21 +1273,16 @@ async def websocket_endpoint(ws: WebSocket, room_id: str):
     if not session_id:
         await ws.close(code=1008)
         return
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT users.id, users.username, users.avatar_path FROM sessions
-        JOIN users ON users.id = sessions.user_id
-        WHERE sessions.id = ?
-        """,
-        (session_id,),
+    # same cache as HTTP requests; only a miss needs a trip to the threadpool
+    user = cached_session_user(session_id) or await run_in_threadpool(
+        lookup_session_user, session_id
     )
-    user = cur.fetchone()
-    conn.close()
     if not user:
         await ws.close(code=1008)
         return
+    # bound once here so the receive loop never indexes the row again
+    uid, uname = user["id"], user["username"]
+    author = {"user_id": uid, "username": uname, "avatar": user["avatar_path"]}
 
     try:
         uuid.UUID(room_id)
@@ -926,173 +1290,89 @@ async def websocket_endpoint(ws: WebSocket, room_id: str):
         await ws.close(code=1008)
         return
 
-    ensure_room(room_id)
     if room_id in rooms_deleted:
         await ws.close(code=4100)
         return
-    if user["id"] in rooms_banned.get(room_id, set()):
+    room = ensure_room(room_id)
+    if uid in room.banned:
         await ws.close(code=4003)
         return
-    rooms_connections[room_id].add(ws)
-    rooms_user_sockets.setdefault(room_id, {}).setdefault(user["id"], set()).add(ws)
-    rooms_user_meta.setdefault(room_id, {})[user["id"]] = {
-        "username": user["username"],
-        "avatar": user["avatar_path"],
-    }
-
-    await broadcast(
-        room_id,
+    out_q: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_MAX)
+    room.connections[ws] = out_q
+    sender = asyncio.create_task(socket_sender(room, ws, out_q))
+    room.user_sockets.setdefault(uid, set()).add(ws)
+    room.user_meta[uid] = {"username": uname, "avatar": author["avatar"]}
+
+    broadcast(
+        room,
         {
             "type": "system",
-            "text": f"{user['username']} entrou na sala",
+            "text": f"{uname} entrou na sala",
             "ts": now_iso(),
         },
     )
 
-    for msg in rooms_messages.get(room_id, []):
-        await ws.send_json(msg)
+    if room.messages:
+        # replay history as one frame instead of one send per message
+        out_q.put_nowait(b'{"type":"backlog","items":[' + b",".join(room.messages) + b"]}")
 
+    loads, dumps, get_builder = orjson.loads, orjson.dumps, MESSAGE_BUILDERS.get
     try:
         while True:
             data = await ws.receive_text()
-            msg = None
-            try:
-                payload = json.loads(data)
-                if isinstance(payload, dict) and payload.get("type") == "message":
-                    msg = {
-                        "type": "message",
-                        "text": payload.get("text", ""),
-                        "enc": payload.get("enc", False),
-                        "ct": payload.get("ct", ""),
-                        "iv": payload.get("iv", ""),
-                        "salt": payload.get("salt", ""),
-                        "msg_id": payload.get("msg_id", ""),
-                        "user_id": user["id"],
-                        "username": user["username"],
-                        "avatar": user["avatar_path"],
-                        "ts": now_iso(),
-                    }
-                if isinstance(payload, dict) and payload.get("type") == "media":
-                    msg = {
-                        "type": "media",
-                        "url": payload.get("url", ""),
-                        "kind": payload.get("kind", "application/octet-stream"),
-                        "enc": payload.get("enc", False),
-                        "iv": payload.get("iv", ""),
-                        "salt": payload.get("salt", ""),
-                        "orig_kind": payload.get("orig_kind", ""),
-                        "msg_id": payload.get("msg_id", ""),
-                        "user_id": user["id"],
-                        "username": user["username"],
-                        "avatar": user["avatar_path"],
-                        "ts": now_iso(),
-                    }
-                if isinstance(payload, dict) and payload.get("type") == "album":
-                    msg = {
-                        "type": "album",
-                        "url": payload.get("url", ""),
-                        "title": payload.get("title", ""),
-                        "enc": payload.get("enc", False),
-                        "ct": payload.get("ct", ""),
-                        "iv": payload.get("iv", ""),
-                        "salt": payload.get("salt", ""),
-                        "msg_id": payload.get("msg_id", ""),
-                        "user_id": user["id"],
-                        "username": user["username"],
-                        "avatar": user["avatar_path"],
-                        "ts": now_iso(),
-                    }
-                if isinstance(payload, dict) and payload.get("type") == "location":
-                    if payload.get("enc"):
-                        msg = {
-                            "type": "location",
-                            "enc": True,
-                            "ct": payload.get("ct", ""),
-                            "iv": payload.get("iv", ""),
-                            "salt": payload.get("salt", ""),
-                            "msg_id": payload.get("msg_id", ""),
-                            "user_id": user["id"],
-                            "username": user["username"],
-                            "avatar": user["avatar_path"],
-                            "ts": now_iso(),
-                        }
-                    else:
-                        msg = {
-                            "type": "location",
-                            "lat": float(payload.get("lat", 0)),
-                            "lon": float(payload.get("lon", 0)),
-                            "msg_id": payload.get("msg_id", ""),
-                            "user_id": user["id"],
-                            "username": user["username"],
-                            "avatar": user["avatar_path"],
-                            "ts": now_iso(),
-                        }
-                if isinstance(payload, dict) and payload.get("type") == "typing":
-                    msg = {
-                        "type": "typing",
-                        "state": bool(payload.get("state", False)),
-                        "user_id": user["id"],
-                        "username": user["username"],
-                        "ts": now_iso(),
-                    }
-                if isinstance(payload, dict) and payload.get("type") == "read":
-                    msg = {
-                        "type": "read",
-                        "msg_id": payload.get("msg_id", ""),
-                        "user_id": user["id"],
-                        "username": user["username"],
-                        "ts": now_iso(),
-                    }
-            except Exception:
-                msg = None
-
-            if msg is None:
-                msg = {
-                    "type": "message",
-                    "text": data,
-                    "enc": False,
-                    "user_id": user["id"],
-                    "username": user["username"],
-                    "avatar": user["avatar_path"],
-                    "ts": now_iso(),
-                }
-            rooms_messages[room_id].append(msg)
-
-            dead = []
-            for conn in rooms_connections.get(room_id, set()):
+            if len(data) > MAX_MSG_CHARS:
+                await ws.close(code=1009)
+                break
+            ts = now_iso()
+            msg = encoded = None
+            # only a JSON object can name a message kind; skip the parser for anything else
+            if data[:1] == "{":
                 try:
-                    await conn.send_json(msg)
-                except Exception:
-                    dead.append(conn)
-            for conn in dead:
-                rooms_connections[room_id].discard(conn)
+                    payload = loads(data)
+                    # one type guard; anything that isn't a known kind falls back to plain text
+                    if isinstance(payload, dict):
+                        builder = get_builder(payload.get("type"))
+                        if builder is not None:
+                            msg = builder(payload, author, ts)
+                            # encode before the dedup check records this event as sent
+                            encoded = dumps(msg)
+                            if is_repeat_ephemeral(room, msg):
+                                continue
+                except (ValueError, TypeError, RecursionError):
+                    # not JSON (orjson.JSONDecodeError is a ValueError), bad field types, or
+                    # nested deeper than orjson will write back (JSONEncodeError is a TypeError)
+                    encoded = None
+
+            if encoded is None:
+                msg = build_plain(data, author, ts)
+                encoded = dumps(msg)
+            if msg["type"] not in EPHEMERAL_TYPES:
+                room.messages.append(encoded)
+            fanout(room, encoded)
+            # receive_text doesn't yield while frames are already buffered; let the senders
+            # drain before the next one so a burst isn't mistaken for slow peers
+            await asyncio.sleep(0)
     except WebSocketDisconnect:
-        rooms_connections[room_id].discard(ws)
-        rooms_user_sockets.get(room_id, {}).get(user["id"], set()).discard(ws)
-        if not rooms_user_sockets.get(room_id, {}).get(user["id"]):
-            rooms_user_meta.get(room_id, {}).pop(user["id"], None)
-            await broadcast(
-                room_id,
-                {
-                    "type": "system",
-                    "text": f"{user['username']} saiu da sala",
-                    "ts": now_iso(),
-                },
-            )
+        pass
     except Exception:
-        rooms_connections[room_id].discard(ws)
-        rooms_user_sockets.get(room_id, {}).get(user["id"], set()).discard(ws)
-        if not rooms_user_sockets.get(room_id, {}).get(user["id"]):
-            rooms_user_meta.get(room_id, {}).pop(user["id"], None)
-            await broadcast(
-                room_id,
-                {
-                    "type": "system",
-                    "text": f"{user['username']} saiu da sala",
-                    "ts": now_iso(),
-                },
-            )
+        # anything but a disconnect is a server-side fault: tell the client, if it's still there
         try:
             await ws.close(code=1011)
-        except Exception:
+        except SOCKET_SEND_ERRORS:
             pass
+    finally:
+        sender.cancel()
+        leave_room(room, ws, uid, uname)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # rooms live in this process's memory, so a single worker serves every socket
+    uvicorn.run(
+        app,
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+    )
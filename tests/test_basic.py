@@ -1,48 +1,87 @@
-import importlib
 import os
+import sys
 import tempfile
+from contextlib import contextmanager
 from io import BytesIO
 from pathlib import Path
 
-import sys
-
 import pytest
+from fastapi import WebSocketDisconnect
 from fastapi.testclient import TestClient
 
 
-def make_client():
+@pytest.fixture(scope="session")
+def app():
+    # import main once, pointed at a throwaway data dir shared by the whole session
     repo_root = Path(__file__).resolve().parents[1]
     if str(repo_root) not in sys.path:
         sys.path.insert(0, str(repo_root))
-    tmp = tempfile.TemporaryDirectory()
-    os.environ["DATA_DIR"] = tmp.name
-    os.environ["DB_PATH"] = os.path.join(tmp.name, "app.db")
-    os.environ["UPLOAD_DIR"] = os.path.join(tmp.name, "uploads")
+    with tempfile.TemporaryDirectory() as tmp, pytest.MonkeyPatch.context() as mp:
+        # restored on teardown so nothing is left pointing at the deleted tmp dir
+        mp.setenv("DATA_DIR", tmp)
+        mp.setenv("DB_PATH", os.path.join(tmp, "app.db"))
+        mp.setenv("UPLOAD_DIR", os.path.join(tmp, "uploads"))
+        import main
+
+        yield main.app
+
+
+def reset_state():
     import main
 
-    importlib.reload(main)
-    client = TestClient(main.app)
-    client._tmp = tmp
-    return client
+    with main.get_db() as conn:
+        tables = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        ).fetchall()
+        for (table,) in tables:
+            conn.execute(f"DELETE FROM {table}")
+    with main.session_cache_lock:
+        main.session_cache.clear()
+    main.rooms.clear()
+    main.rooms_deleted.clear()
 
 
 @pytest.fixture()
-def client():
-    return make_client()
+def client(app):
+    yield TestClient(app)
+    reset_state()
 
 
-def register_and_login(client):
-    client.get("/")
-    captcha = client.cookies.get("captcha_answer", "")
-    r = client.post("/auth/register", data={"username": "u1", "password": "p1", "captcha": captcha})
+def register_and_login(client, username="u1", password="p1"):
+    # the captcha answer round-trips through a cookie, so set it instead of rendering /
+    # (and don't follow the redirects, which would render pages and re-roll it)
+    client.cookies.set("captcha_answer", "2")
+    form = {"username": username, "password": password, "captcha": "2"}
+    r = client.post("/auth/register", data=form, allow_redirects=False)
     assert r.status_code in (200, 303)
-    client.get("/")
-    captcha = client.cookies.get("captcha_answer", "")
-    r = client.post("/auth/login", data={"username": "u1", "password": "p1", "captcha": captcha})
+    r = client.post("/auth/login", data=form, allow_redirects=False)
     assert r.status_code in (200, 303)
     return r.cookies
 
 
+def receive_events(ws):
+    frame = ws.receive_json(mode="binary")
+    return frame["items"] if frame["type"] == "batch" else [frame]
+
+
+def new_room(client, username="u1"):
+    register_and_login(client, username)
+    location = client.get("/new", allow_redirects=False).headers["location"]
+    return location.split("/room/")[-1]
+
+
+def read_join_and_backlog(ws):
+    # the join notice and the backlog go out as one batch frame or as two frames,
+    # depending on whether the sender woke up in between
+    events = receive_events(ws)
+    if len(events) == 1:
+        events += receive_events(ws)
+    join, backlog = events
+    assert join["type"] == "system"
+    assert backlog["type"] == "backlog"
+    return backlog["items"]
+
+
 def test_auth_and_app_access(client):
     cookies = register_and_login(client)
     r = client.get("/app", cookies=cookies)
@@ -81,3 +120,228 @@ def test_album_share_flow(client):
     assert r.status_code == 200
     r = client.post(f"/album/share/revoke/{token}", cookies=cookies)
     assert r.status_code == 200
+
+
+def test_my_albums_groups_media(client):
+    cookies = register_and_login(client)
+    for caption, names in (("one", ["a.png"]), ("two", ["b.png", "c.png"])):
+        files = [("files", (n, BytesIO(b"fake"), "image/png")) for n in names]
+        r = client.post("/albums", cookies=cookies, data={"caption": caption}, files=files)
+        assert r.status_code in (200, 303)
+    r = client.get("/albums/me", cookies=cookies)
+    albums = {a["caption"]: a for a in r.json()["albums"]}
+    assert len(albums["one"]["media"]) == 1
+    assert len(albums["two"]["media"]) == 2
+    assert all(m["album_id"] == albums["two"]["id"] for m in albums["two"]["media"])
+    r = client.get(albums["one"]["media"][0]["path"])
+    assert r.content == b"fake"
+
+
+def test_nearby_users_radius_and_blocks(client):
+    near = TestClient(client.app)
+    far = TestClient(client.app)
+    register_and_login(client, "u1")
+    register_and_login(near, "u2")
+    register_and_login(far, "u3")
+    client.post("/me/location", data={"lat": -23.55, "lon": -46.63})
+    near.post("/me/location", data={"lat": -23.56, "lon": -46.64})
+    far.post("/me/location", data={"lat": -22.90, "lon": -43.17})
+    r = client.get("/users/nearby?radius_km=5")
+    assert [u["username"] for u in r.json()["users"]] == ["u2"]
+    r = client.post(f"/block/{r.json()['users'][0]['id']}")
+    assert r.status_code == 200
+    r = near.get("/users/nearby?radius_km=5")
+    assert r.json()["users"] == []
+
+
+def test_nearby_users_box_does_not_clip_wide_or_polar_circles(client):
+    edge = TestClient(client.app)
+    register_and_login(client, "u1")
+    register_and_login(edge, "u2")
+    # 999 km away, just inside the circle's widest longitude (12.77 deg at 45N)
+    client.post("/me/location", data={"lat": 45.0, "lon": 0.0})
+    edge.post("/me/location", data={"lat": 45.6, "lon": 12.76})
+    r = client.get("/users/nearby?radius_km=1000")
+    assert [u["username"] for u in r.json()["users"]] == ["u2"]
+    # ~1112 km across the pole: the circle covers every longitude
+    client.post("/me/location", data={"lat": 85.0, "lon": 0.0})
+    edge.post("/me/location", data={"lat": 85.0, "lon": 180.0})
+    r = client.get("/users/nearby?radius_km=1200")
+    assert [u["username"] for u in r.json()["users"]] == ["u2"]
+
+
+def test_websocket_room_broadcast(client):
+    room_id = new_room(client)
+    with client.websocket_connect(f"/ws/{room_id}") as ws:
+        assert receive_events(ws)[0]["type"] == "system"
+        ws.send_text('{"type": "message", "text": "oi", "msg_id": "m1"}')
+        (msg,) = receive_events(ws)
+        assert msg["type"] == "message"
+        assert msg["text"] == "oi"
+        assert msg["username"] == "u1"
+
+
+def test_profile_update_and_logout_refresh_session(client):
+    register_and_login(client)
+    r = client.post("/me/profile", data={"username": "u1-new", "bio": "oi"})
+    assert r.status_code in (200, 303)
+    r = client.get("/app")
+    assert "u1-new" in r.text
+    session = client.cookies.get("session")
+    client.post("/auth/logout")
+    r = client.get("/app", cookies={"session": session}, allow_redirects=False)
+    assert r.status_code in (302, 307)
+
+
+def test_websocket_replays_history_as_backlog(client):
+    room_id = new_room(client)
+    with client.websocket_connect(f"/ws/{room_id}") as ws:
+        receive_events(ws)
+        for i in range(3):
+            ws.send_text(f'{{"type": "message", "text": "m{i}", "msg_id": "id{i}"}}')
+            receive_events(ws)
+    with client.websocket_connect(f"/ws/{room_id}") as ws:
+        backlog = read_join_and_backlog(ws)
+        assert [m["text"] for m in backlog] == ["m0", "m1", "m2"]
+
+
+def test_fanout_evicts_peer_with_full_queue(client):
+    import asyncio
+
+    import main
+
+    room = main.Room()
+    fast, slow = asyncio.Queue(maxsize=2), asyncio.Queue(maxsize=1)
+    room.connections = {"fast": fast, "slow": slow}
+    main.fanout(room, b"a")
+    main.fanout(room, b"b")
+    assert list(room.connections) == ["fast"]
+    assert [fast.get_nowait(), fast.get_nowait()] == [b"a", b"b"]
+    assert slow.get_nowait() is None and slow.empty()
+
+
+def test_websocket_typing_is_deduplicated_and_not_kept(client):
+    room_id = new_room(client)
+    with client.websocket_connect(f"/ws/{room_id}") as ws:
+        receive_events(ws)
+        ws.send_text('{"type": "typing", "state": true}')
+        ws.send_text('{"type": "typing", "state": true}')
+        ws.send_text('{"type": "message", "text": "oi", "msg_id": "m1"}')
+        events = []
+        while not events or events[-1]["type"] != "message":
+            events += receive_events(ws)
+        assert [e["type"] for e in events] == ["typing", "message"]
+    with client.websocket_connect(f"/ws/{room_id}") as ws:
+        assert [m["type"] for m in read_join_and_backlog(ws)] == ["message"]
+
+
+def test_websocket_rejects_logged_out_session(client):
+    import main
+
+    room_id = new_room(client)
+    with client.websocket_connect(f"/ws/{room_id}") as ws:
+        receive_events(ws)
+    session = client.cookies.get("session")
+    client.post("/auth/logout")
+    client.cookies.set("session", session)
+    with client.websocket_connect(f"/ws/{room_id}") as ws:
+        with pytest.raises(WebSocketDisconnect) as exc:
+            receive_events(ws)
+    assert exc.value.code == 1008
+    # and again with a cold cache, so the lookup has to go to the database
+    with main.session_cache_lock:
+        main.session_cache.clear()
+    with client.websocket_connect(f"/ws/{room_id}") as ws:
+        with pytest.raises(WebSocketDisconnect) as exc:
+            receive_events(ws)
+    assert exc.value.code == 1008
+
+
+def test_session_lookup_racing_logout_is_not_cached(client, monkeypatch):
+    import main
+
+    register_and_login(client)
+    session = client.cookies.get("session")
+    with main.session_cache_lock:
+        main.session_cache.clear()
+    real_get_db = main.get_db
+    raced = []
+
+    @contextmanager
+    def get_db_then_logout():
+        # the lookup has read the session row; log out before it gets to cache it
+        with real_get_db() as conn:
+            yield conn
+        if not raced:
+            raced.append(True)
+            client.post("/auth/logout", allow_redirects=False)
+
+    monkeypatch.setattr(main, "get_db", get_db_then_logout)
+    assert main.lookup_session_user(session)["username"] == "u1"
+    monkeypatch.undo()
+    assert raced
+    assert main.cached_session_user(session) is None
+    assert main.lookup_session_user(session) is None
+
+
+def test_now_iso_matches_utcnow_format(client):
+    import main
+
+    first, second = main.now_iso(), main.now_iso()
+    for value in (first, second):
+        parsed = main.parse_iso(value)
+        assert parsed.tzinfo is None
+        assert abs((main.now_dt() - parsed).total_seconds()) < 1
+    assert first <= second
+
+
+def test_websocket_closes_on_oversized_frame(client):
+    import main
+
+    room_id = new_room(client)
+    with client.websocket_connect(f"/ws/{room_id}") as ws:
+        receive_events(ws)
+        ws.send_text("x" * (main.MAX_MSG_CHARS + 1))
+        with pytest.raises(WebSocketDisconnect) as exc:
+            receive_events(ws)
+    assert exc.value.code == 1009
+
+
+def test_websocket_survives_deeply_nested_payload(client):
+    room_id = new_room(client)
+    nested = "[" * 300 + "]" * 300
+    frame = '{"type": "message", "text": ' + nested + ', "msg_id": "m1"}'
+    with client.websocket_connect(f"/ws/{room_id}") as ws:
+        receive_events(ws)
+        ws.send_text(frame)
+        (msg,) = receive_events(ws)
+        assert msg["type"] == "message"
+        assert msg["text"] == frame
+        ws.send_text('{"type": "message", "text": "oi", "msg_id": "m2"}')
+        assert receive_events(ws)[0]["text"] == "oi"
+    with client.websocket_connect(f"/ws/{room_id}") as ws:
+        assert [m["text"] for m in read_join_and_backlog(ws)] == [frame, "oi"]
+
+
+def test_websocket_burst_does_not_evict_reading_peers(client):
+    import main
+
+    bob = TestClient(client.app)
+    room_id = new_room(client, "u1")
+    register_and_login(bob, "u2")
+    burst = main.SEND_QUEUE_MAX + 100
+    # both sockets must share one event loop (one portal), as they do under uvicorn
+    alice_cookie = {"cookie": f"session={client.cookies.get('session')}"}
+    bob_cookie = {"cookie": f"session={bob.cookies.get('session')}"}
+    with client:
+        with client.websocket_connect(f"/ws/{room_id}", headers=alice_cookie) as alice_ws:
+            with client.websocket_connect(f"/ws/{room_id}", headers=bob_cookie) as bob_ws:
+                (joined,) = receive_events(bob_ws)  # bob is registered in the room now
+                assert joined["text"] == "u2 entrou na sala"
+                for i in range(burst):
+                    alice_ws.send_text(f'{{"type": "message", "text": "m{i}", "msg_id": "{i}"}}')
+                texts = []
+                while len(texts) < burst:
+                    events = receive_events(bob_ws)
+                    texts += [e["text"] for e in events if e["type"] == "message"]
+                assert texts == [f"m{i}" for i in range(burst)]